@@ -18,6 +18,8 @@ Run YugaByte tests on Spark using PySpark.
 """
 
 import argparse
+import errno
+import functools
 import glob
 import json
 import logging
@@ -25,8 +27,11 @@ import os
 import random
 import re
 import socket
+import subprocess
 import sys
+import tempfile
 import time
+import traceback
 import pwd
 from collections import defaultdict
 
@@ -56,7 +61,16 @@ LIST_OF_TESTS_DIR_NAME = 'list_of_tests'
 
 # Global variables.
 propagated_env_vars = {}
-global_conf_dict = None
+
+# Broadcast variables holding the global test configuration (as a dictionary) and the propagated
+# environment variables. These are serialized once and fetched by every Spark executor, instead of
+# being pickled into every task.
+global_conf_bcast = None
+propagated_env_vars_bcast = None
+
+# A Spark accumulator that test-running tasks add a summary of their results to (see
+# new_test_results_summary).
+test_results_summary_accumulator = None
 
 DEFAULT_SPARK_MASTER_URL = 'spark://buildmaster.c.yugabyte.internal:7077'
 
@@ -67,18 +81,36 @@ spark_context = None
 
 # Non-gtest tests and tests with internal dependencies that we should run in one shot. This almost
 # duplicates a  from common-test-env.sh, but that is probably OK since we should not be adding new
-# such tests.
-ONE_SHOT_TESTS = set([
+# such tests. Most of these are identified by test program name (regardless of directory), and the
+# rest by their path relative to the build root.
+ONE_SHOT_TEST_NAMES = set([
         'merge_test',
         'c_test',
         'compact_on_deletion_collector_test',
-        'db_sanity_test',
+        'db_sanity_test'])
+ONE_SHOT_TEST_REL_PATHS = set([
         'tests-rocksdb/thread_local_test'])
 
-HASH_COMMENT_RE = re.compile('#.*$')
-
 SPARK_TASK_MAX_FAILURES = 32
 
+# The default number of Spark tasks to run tests in per core of the Spark cluster.
+DEFAULT_TASKS_PER_CORE = 4
+
+# Approximate number of C++ test programs to list gtest tests for in one Spark task. Listing tests
+# in one program can take about a second (e.g. on TSAN), so we only batch programs this way when
+# there are enough of them to keep every core of the Spark cluster busy.
+NUM_TEST_PROGRAMS_PER_LIST_TASK = 24
+
+# The exit code we report for a test when the test framework itself fails to run it, e.g. if we
+# cannot start run-test.sh or write the test's error log.
+TEST_FRAMEWORK_ERROR_EXIT_CODE = 255
+
+# Size of chunks in which we copy the output of a test to the error log and to standard error.
+TEST_OUTPUT_COPY_BUFFER_SIZE = 65536
+
+# The number of most recent stats files to use to estimate how long each test takes to run.
+NUM_PRIOR_STATS_FILES_TO_LOAD = 10
+
 verbose = False
 
 
@@ -92,7 +124,10 @@ def init_spark_context():
     # retries.
     # https://stackoverflow.com/questions/26260006/are-failed-tasks-resubmitted-in-apache-spark
     # NOTE: we never retry failed tests to avoid hiding bugs. This failure tolerance mechanism
-    #       is just for the resilience of the test framework itself.
+    #       is just for the resilience of the test framework itself. Each task runs several tests,
+    #       so parallel_run_tests reports errors running a particular test as a failure of that test
+    #       instead of failing the task. Still, if a task is retried (e.g. because its executor
+    #       is lost), all tests in its partition are re-run.
     SparkContext.setSystemProperty('spark.task.maxFailures', str(SPARK_TASK_MAX_FAILURES))
     spark_master_url = os.environ.get('YB_SPARK_MASTER_URL', DEFAULT_SPARK_MASTER_URL)
     spark_context = SparkContext(spark_master_url, "YB tests (build type: {})".format(build_type))
@@ -105,101 +140,218 @@ def adjust_pythonpath():
 
 
 def set_global_conf_for_spark_jobs():
-    global global_conf_dict
-    global_conf_dict = vars(yb_dist_tests.global_conf)
+    global global_conf_bcast
+    global propagated_env_vars_bcast
+    if global_conf_bcast is not None:
+        return
+    global_conf_bcast = spark_context.broadcast(vars(yb_dist_tests.global_conf))
+    propagated_env_vars_bcast = spark_context.broadcast(propagated_env_vars)
+
+
+def copy_test_output(input_fd, error_output_path):
+    """
+    Copies everything readable from the given file descriptor to the error output file and to
+    standard error, until end of file. The error output file is only created once there is some
+    output, so that we don't create (and then have to delete) empty files for tests that don't
+    output anything. If there is no output, a file left at that path by a previous run is removed.
+    """
+    output_fds = [sys.stderr.fileno()]
+    error_output_fd = None
+    try:
+        while True:
+            data = os.read(input_fd, TEST_OUTPUT_COPY_BUFFER_SIZE)
+            if not data:
+                break
+            if error_output_fd is None:
+                error_output_fd = os.open(
+                        error_output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                output_fds.append(error_output_fd)
+            for output_fd in output_fds:
+                num_bytes_written = 0
+                while num_bytes_written < len(data):
+                    num_bytes_written += os.write(output_fd, data[num_bytes_written:])
+    finally:
+        if error_output_fd is not None:
+            os.close(error_output_fd)
+
+    if error_output_fd is None:
+        try:
+            os.remove(error_output_path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
 
 
-def parallel_run_test(test_descriptor_str):
+def run_test_process(args, error_output_path):
+    """
+    Runs the given run-test.sh command line and returns its exit code.
     """
-    This is invoked in parallel to actually run tests.
+    # We could use "run_program" here, but it collects all the output in memory, which is not
+    # ideal for a large amount of test log output. Instead, we copy the output to the error log
+    # file as it arrives, and also to the standard error of the Spark task, which is sometimes
+    # helpful for debugging.
+    test_process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    copy_succeeded = False
+    try:
+        copy_test_output(test_process.stdout.fileno(), error_output_path)
+        copy_succeeded = True
+    finally:
+        test_process.stdout.close()
+        if not copy_succeeded:
+            # Don't leave the test running in the background, e.g. competing for ports and log
+            # paths with a retry of this task on the same host.
+            test_process.kill()
+            test_process.wait()
+    return test_process.wait()
+
+
+def parallel_run_tests(test_descriptor_strs):
+    """
+    This is invoked in parallel to actually run tests. Each invocation runs all tests in a partition
+    (an iterable of test descriptor strings), so that the setup below is done once per partition,
+    and yields a TestResult for every test. A summary of the results is also added to
+    test_results_summary_accumulator.
+
+    Errors running individual tests are reported as test failures rather than failing the task.
+    However, if the task as a whole still fails (e.g. because an executor is lost), Spark re-runs
+    every test in the partition, including the ones that have already finished.
     """
     adjust_pythonpath()
-    from yb import yb_dist_tests, command_util
+    from yb import yb_dist_tests
 
-    global_conf = yb_dist_tests.set_global_conf_from_dict(global_conf_dict)
-    global_conf.set_env(propagated_env_vars)
-    yb_dist_tests.global_conf = global_conf
-    test_descriptor = yb_dist_tests.TestDescriptor(test_descriptor_str)
-    os.environ['YB_TEST_ATTEMPT_INDEX'] = str(test_descriptor.attempt_index)
+    global_conf = yb_dist_tests.init_spark_worker(
+            global_conf_bcast.value, propagated_env_vars_bcast.value)
     os.environ['build_type'] = global_conf.build_type
+    run_test_script_path = global_conf.get_run_test_script_path()
+    hostname = socket.gethostname()
+    yb_dist_tests.wait_for_clock_sync_once()
 
-    yb_dist_tests.wait_for_clock_sync()
-    start_time = time.time()
+    for test_descriptor_str in test_descriptor_strs:
+        test_descriptor = yb_dist_tests.TestDescriptor(test_descriptor_str)
+        os.environ['YB_TEST_ATTEMPT_INDEX'] = str(test_descriptor.attempt_index)
 
-    # We could use "run_program" here, but it collects all the output in memory, which is not
-    # ideal for a large amount of test log output. The "tee" part also makes the output visible in
-    # the standard error of the Spark task as well, which is sometimes helpful for debugging.
-    exit_code = os.system(
-            ("bash -c 'set -o pipefail; \"{}\" {} 2>&1 | tee \"{}\"'").format(
-                    global_conf.get_run_test_script_path(),
-                    test_descriptor.args_for_run_test,
-                    test_descriptor.error_output_path)) >> 8
-    # The ">> 8" is to get the exit code returned by os.system() in the high 8 bits of the result.
-    elapsed_time_sec = time.time() - start_time
-
-    logging.info("Test {} ran on {}, rc={}".format(
-        test_descriptor, socket.gethostname(), exit_code))
-    error_output_path = test_descriptor.error_output_path
-    if os.path.isfile(error_output_path) and os.path.getsize(error_output_path) == 0:
-        os.remove(error_output_path)
-
-    return yb_dist_tests.TestResult(
-            exit_code=exit_code,
-            test_descriptor=test_descriptor,
-            elapsed_time_sec=elapsed_time_sec)
-
-
-def parallel_list_test_descriptors(rel_test_path):
+        start_time = time.time()
+        try:
+            # Arguments are split on whitespace the same way the shell used to split them when we
+            # ran the test through "bash -c".
+            exit_code = run_test_process(
+                    [run_test_script_path] + test_descriptor.args_for_run_test.split(),
+                    test_descriptor.error_output_path)
+        except Exception:
+            # If we let this exception fail the Spark task, Spark would re-run the whole partition,
+            # including tests that have already finished (and possibly failed), and the results of
+            # those earlier runs would be lost. Instead, we report this test as failed.
+            sys.stderr.write("Failed to run test {}:\n".format(test_descriptor_str))
+            traceback.print_exc()
+            exit_code = TEST_FRAMEWORK_ERROR_EXIT_CODE
+        elapsed_time_sec = time.time() - start_time
+
+        logging.info("Test %s ran on %s, rc=%s", test_descriptor, hostname, exit_code)
+
+        result = yb_dist_tests.TestResult(
+                exit_code=exit_code,
+                test_descriptor=test_descriptor,
+                elapsed_time_sec=elapsed_time_sec)
+        test_results_summary_accumulator.add(
+                add_result_to_summary(new_test_results_summary(), result))
+        yield result
+
+
+def parallel_find_java_test_descriptor_strs(java_module):
+    """
+    This is invoked in parallel to find Java/Scala tests in one Maven module. The argument is a
+    tuple of a Java source root and a module directory name within it. Returns a tuple of the test
+    descriptor strings found and the paths of skipped files (see find_java_test_descriptor_strs).
+    """
+    adjust_pythonpath()
+    from yb import yb_dist_tests
+    java_src_root, java_module_name = java_module
+    return yb_dist_tests.find_java_test_descriptor_strs(java_src_root, java_module_name)
+
+
+def parallel_list_test_descriptors(rel_test_paths):
     """
     This is invoked in parallel to list all individual tests within our C++ test programs. Without
     this, listing all gtest tests across 330 test programs might take about 5 minutes on TSAN and 2
-    minutes in debug.
+    minutes in debug. Each invocation handles a whole partition (an iterable of test program paths
+    relative to the build root), so that the setup below is done once per batch of programs.
     """
     adjust_pythonpath()
-    from yb import yb_dist_tests, command_util
-    global_conf = yb_dist_tests.set_global_conf_from_dict(global_conf_dict)
-    global_conf.set_env(propagated_env_vars)
-    prog_result = command_util.run_program(
-            [os.path.join(global_conf.build_root, rel_test_path), '--gtest_list_tests'])
-
-    # --gtest_list_tests gives us the following output format:
-    #  TestSplitArgs.
-    #    Simple
-    #    SimpleWithSpaces
-    #    SimpleWithQuotes
-    #    BadWithQuotes
-    #    Empty
-    #    Error
-    #    BloomFilterReverseCompatibility
-    #    BloomFilterWrapper
-    #    PrefixExtractorFullFilter
-    #    PrefixExtractorBlockFilter
-    #    PrefixScan
-    #    OptimizeFiltersForHits
-    #  BloomStatsTestWithParam/BloomStatsTestWithParam.
-    #    BloomStatsTest/0  # GetParam() = (true, true)
-    #    BloomStatsTest/1  # GetParam() = (true, false)
-    #    BloomStatsTest/2  # GetParam() = (false, false)
-    #    BloomStatsTestWithIter/0  # GetParam() = (true, true)
-    #    BloomStatsTestWithIter/1  # GetParam() = (true, false)
-    #    BloomStatsTestWithIter/2  # GetParam() = (false, false)
-
-    current_test = None
-    test_descriptors = []
-    test_descriptor_prefix = rel_test_path + yb_dist_tests.TEST_DESCRIPTOR_SEPARATOR
-    for line in prog_result.stdout.split("\n"):
-        if ('Starting tracking the heap' in line or 'Dumping heap profile to' in line):
-            continue
-        line = line.rstrip()
-        trimmed_line = HASH_COMMENT_RE.sub('', line.strip()).strip()
-        if line.startswith('  '):
-            test_descriptors.append(test_descriptor_prefix + current_test + trimmed_line)
-        else:
-            current_test = trimmed_line
+    from yb import yb_dist_tests
+    global_conf = yb_dist_tests.init_spark_worker(
+            global_conf_bcast.value, propagated_env_vars_bcast.value)
+
+    for rel_test_path in rel_test_paths:
+        # We read the standard output of the test program line by line instead of using
+        # run_program, which would buffer all of it in memory. Standard error goes to a temporary
+        # file so that it does not get mixed into the test list (e.g. sanitizer reports contain
+        # indented lines that would look like test names), and is only used for error reporting.
+        list_tests_cmd = [os.path.join(global_conf.build_root, rel_test_path), '--gtest_list_tests']
+        list_tests_stderr_file = tempfile.TemporaryFile()
+        list_tests_process = subprocess.Popen(
+                list_tests_cmd, stdout=subprocess.PIPE, stderr=list_tests_stderr_file, bufsize=1)
+
+        # --gtest_list_tests gives us the following output format:
+        #  TestSplitArgs.
+        #    Simple
+        #    SimpleWithSpaces
+        #    SimpleWithQuotes
+        #    BadWithQuotes
+        #    Empty
+        #    Error
+        #    BloomFilterReverseCompatibility
+        #    BloomFilterWrapper
+        #    PrefixExtractorFullFilter
+        #    PrefixExtractorBlockFilter
+        #    PrefixScan
+        #    OptimizeFiltersForHits
+        #  BloomStatsTestWithParam/BloomStatsTestWithParam.
+        #    BloomStatsTest/0  # GetParam() = (true, true)
+        #    BloomStatsTest/1  # GetParam() = (true, false)
+        #    BloomStatsTest/2  # GetParam() = (false, false)
+        #    BloomStatsTestWithIter/0  # GetParam() = (true, true)
+        #    BloomStatsTestWithIter/1  # GetParam() = (true, false)
+        #    BloomStatsTestWithIter/2  # GetParam() = (false, false)
+
+        current_test = None
+        test_descriptor_prefix = rel_test_path + yb_dist_tests.TEST_DESCRIPTOR_SEPARATOR
+        for line in iter(list_tests_process.stdout.readline, ''):
+            if ('Starting tracking the heap' in line or 'Dumping heap profile to' in line):
+                continue
+            # Whitespace-only lines must not be mistaken for indented test names below.
+            line = line.rstrip()
+            trimmed_line = line.split('#', 1)[0].strip()
+            if line.startswith('  '):
+                yield test_descriptor_prefix + current_test + trimmed_line
+            else:
+                current_test = trimmed_line
 
-    return test_descriptors
+        list_tests_process.stdout.close()
+        returncode = list_tests_process.wait()
+        with list_tests_stderr_file:
+            if returncode != 0:
+                list_tests_stderr_file.seek(0)
+                raise RuntimeError("Non-zero exit code {} from: {}, stderr: '{}'".format(
+                    returncode, list_tests_cmd, list_tests_stderr_file.read().strip()))
+
+
+def memoize(func):
+    """
+    Caches the result of a function that does not take any arguments. functools.lru_cache is not
+    available in Python 2.
+    """
+    cached_result = []
 
+    @functools.wraps(func)
+    def wrapper():
+        if not cached_result:
+            cached_result.append(func())
+        return cached_result[0]
 
+    return wrapper
+
+
+@memoize
 def get_username():
     try:
         return os.getlogin()
@@ -210,10 +362,12 @@ def get_username():
         return pwd.getpwuid(os.getuid()).pw_name
 
 
+@memoize
 def get_jenkins_job_name():
     return os.environ.get('JOB_NAME', None)
 
 
+@memoize
 def get_jenkins_job_name_path_component():
     jenkins_job_name = get_jenkins_job_name()
     if jenkins_job_name:
@@ -269,17 +423,106 @@ def save_stats(stats_base_dir, results, total_elapsed_time_sec):
         tests=test_stats,
         total_elapsed_time_sec=total_elapsed_time_sec)
     with open(stats_path, 'w') as output_file:
-        output_file.write(json.dumps(stats, sort_keys=True, indent=2))
+        json.dump(stats, output_file, sort_keys=True, indent=2)
         output_file.write("\n")
 
 
+def median(values):
+    sorted_values = sorted(values)
+    n = len(sorted_values)
+    if n % 2 == 1:
+        return sorted_values[n // 2]
+    return (sorted_values[n // 2 - 1] + sorted_values[n // 2]) / 2.0
+
+
+def load_prior_stats(stats_base_dir):
+    """
+    Loads the most recent stats files saved by save_stats for the current build type and Jenkins
+    job.
+
+    @return a dictionary mapping test descriptor strings (without attempt indexes) to the median
+            elapsed time of the corresponding test in seconds.
+    """
+    stats_parent_dir = get_stats_parent_dir(stats_base_dir)
+    # File names start with the build type followed by a timestamp, so sorting them by name puts
+    # the most recent ones last.
+    stats_paths = sorted(glob.glob(os.path.join(stats_parent_dir, '*.json')))
+    stats_paths = stats_paths[-NUM_PRIOR_STATS_FILES_TO_LOAD:]
+
+    elapsed_times_by_test = defaultdict(list)
+    for stats_path in stats_paths:
+        try:
+            with open(stats_path) as input_file:
+                stats = json.load(input_file)
+        except (IOError, ValueError) as ex:
+            logging.warning("Could not load test stats from {}: {}".format(stats_path, ex))
+            continue
+        # These stats are only used to order tests, so we skip anything malformed instead of
+        # failing the whole run.
+        tests_stats = stats.get('tests') if isinstance(stats, dict) else None
+        if not isinstance(tests_stats, dict):
+            logging.warning("No per-test stats dictionary found in {}".format(stats_path))
+            continue
+        num_invalid_entries = 0
+        for test_descriptor_str, test_stats in tests_stats.iteritems():
+            elapsed_time_sec = (test_stats.get('elapsed_time_sec')
+                                if isinstance(test_stats, dict) else None)
+            if (not isinstance(test_descriptor_str, basestring) or
+                    not isinstance(elapsed_time_sec, (int, long, float))):
+                num_invalid_entries += 1
+                continue
+            attempt_index_match = yb_dist_tests.TEST_DESCRIPTOR_ATTEMPT_INDEX_RE.match(
+                    test_descriptor_str)
+            if attempt_index_match:
+                test_descriptor_str = attempt_index_match.group(1)
+            elapsed_times_by_test[test_descriptor_str].append(elapsed_time_sec)
+        if num_invalid_entries:
+            logging.warning("Skipped {} invalid test stats entries in {}".format(
+                num_invalid_entries, stats_path))
+
+    logging.info("Loaded stats for {} tests from {} files in {}".format(
+        len(elapsed_times_by_test), len(stats_paths), stats_parent_dir))
+    return dict((test_descriptor_str, median(elapsed_times))
+                for test_descriptor_str, elapsed_times in elapsed_times_by_test.iteritems())
+
+
+def sort_tests_by_prior_elapsed_time(test_descriptors, stats_base_dir):
+    """
+    Sorts tests so that the ones that took the longest in previous runs come first, which makes it
+    less likely that a few long tests started at the end hold up the whole run. Tests that we have
+    no stats for also go first, because we don't know how long they will take. The sort is stable,
+    so the original order is preserved among tests with the same estimated elapsed time.
+    """
+    prior_elapsed_time_sec = load_prior_stats(stats_base_dir)
+    return sorted(
+            test_descriptors,
+            key=lambda test_descriptor: -prior_elapsed_time_sec.get(
+                test_descriptor.descriptor_str_without_attempt_index, float('inf')))
+
+
 def is_one_shot_test(rel_binary_path):
-    if rel_binary_path in ONE_SHOT_TESTS:
-        return True
-    for non_gtest_test in ONE_SHOT_TESTS:
-        if rel_binary_path.endswith('/' + non_gtest_test):
-            return True
-    return False
+    return (rel_binary_path in ONE_SHOT_TEST_REL_PATHS or
+            os.path.basename(rel_binary_path) in ONE_SHOT_TEST_NAMES)
+
+
+def reservoir_sample(items, k):
+    """
+    Selects k random items out of the given iterable (or all of them if there are fewer than k)
+    in one pass, only keeping the selected items in memory.
+
+    @return a tuple of the list of selected items and the total number of items seen
+    """
+    sample = []
+    num_items = 0
+    for item in items:
+        num_items += 1
+        if len(sample) < k:
+            sample.append(item)
+        else:
+            i = random.randrange(num_items)
+            if i < k:
+                sample[i] = item
+    return sample, num_items
 
 
 def collect_cpp_tests(max_tests, cpp_test_program_re_str):
@@ -307,18 +550,27 @@ def collect_cpp_tests(max_tests, cpp_test_program_re_str):
     logging.info("Collected %d test programs in %.2f sec" % (
         len(test_programs), elapsed_time_sec))
 
+    # Filtering and random selection are done in one pass, without building the full filtered list
+    # when we only need a few test programs out of it.
+    candidate_test_programs = test_programs
     if cpp_test_program_re_str:
         cpp_test_program_re = re.compile(cpp_test_program_re_str)
-        test_programs = [test_program for test_program in test_programs
-                         if cpp_test_program_re.search(test_program)]
+        candidate_test_programs = (test_program for test_program in test_programs
+                                   if cpp_test_program_re.search(test_program))
+
+    if max_tests:
+        test_programs, num_candidates = reservoir_sample(candidate_test_programs, max_tests)
+    else:
+        test_programs = list(candidate_test_programs)
+        num_candidates = len(test_programs)
+
+    if cpp_test_program_re_str:
         logging.info("Filtered down to %d test programs using regular expression '%s'" %
-                     (len(test_programs), cpp_test_program_re_str))
+                     (num_candidates, cpp_test_program_re_str))
 
-    if max_tests and len(test_programs) > max_tests:
-        logging.info("Randomly selecting {} test programs out of {} possible".format(
-                max_tests, len(test_programs)))
-        random.shuffle(test_programs)
-        test_programs = test_programs[:max_tests]
+    if num_candidates > len(test_programs):
+        logging.info("Randomly selected {} test programs out of {} possible".format(
+                len(test_programs), num_candidates))
 
     logging.info("Collecting gtest tests for {} test programs".format(len(test_programs)))
 
@@ -326,21 +578,114 @@ def collect_cpp_tests(max_tests, cpp_test_program_re_str):
     init_spark_context()
     set_global_conf_for_spark_jobs()
 
-    # Use fewer "slices" (tasks) than there are test programs, in hope to get some batching.
-    num_slices = (len(test_programs) + 1) / 2
-    all_test_descriptor_lists = spark_context.parallelize(
-            test_programs, numSlices=num_slices).map(parallel_list_test_descriptors).collect()
+    # Use fewer "slices" (tasks) than there are test programs, so that each task lists tests in a
+    # batch of programs, but no fewer than the number of cores in the Spark cluster, so that they
+    # are all used.
+    num_slices = max(
+            min(len(test_programs), spark_context.defaultParallelism),
+            len(test_programs) // NUM_TEST_PROGRAMS_PER_LIST_TASK,
+            1)
+    test_descriptor_strs += spark_context.parallelize(
+            test_programs, numSlices=num_slices).mapPartitions(
+                    parallel_list_test_descriptors).collect()
     elapsed_time_sec = time.time() - start_time_sec
-    test_descriptor_strs += [
-        test_descriptor_str
-        for test_descriptor_str_list in all_test_descriptor_lists
-        for test_descriptor_str in test_descriptor_str_list]
     logging.info("Collected the list of %d gtest tests in %.2f sec" % (
         len(test_descriptor_strs), elapsed_time_sec))
 
     return [yb_dist_tests.TestDescriptor(s) for s in test_descriptor_strs]
 
 
+def collect_java_tests():
+    logging.info("Collecting the list of Java tests")
+    start_time_sec = time.time()
+    yb_src_root = yb_dist_tests.global_conf.yb_src_root
+
+    # Listing top-level module directories is cheap, so we do it here, and then search for tests
+    # inside of each module on Spark.
+    java_modules = []
+    for java_src_root in [os.path.join(yb_src_root, 'java'),
+                          os.path.join(yb_src_root, 'ent', 'java')]:
+        if not os.path.isdir(java_src_root):
+            continue
+        for java_module_name in sorted(os.listdir(java_src_root)):
+            if (yb_dist_tests.is_java_test_search_dir_name(java_module_name) and
+                    os.path.isdir(os.path.join(java_src_root, java_module_name))):
+                java_modules.append((java_src_root, java_module_name))
+
+    if not java_modules:
+        return []
+
+    init_spark_context()
+    set_global_conf_for_spark_jobs()
+    test_descriptor_strs = []
+    for module_test_descriptor_strs, skipped_paths in spark_context.parallelize(
+            java_modules, numSlices=len(java_modules)).map(
+                    parallel_find_java_test_descriptor_strs).collect():
+        test_descriptor_strs += module_test_descriptor_strs
+        for skipped_path in skipped_paths:
+            logging.warning("Skipping file (does not match expected pattern): " + skipped_path)
+    elapsed_time_sec = time.time() - start_time_sec
+    logging.info("Collected the list of %d Java tests in %d modules in %.2f sec" % (
+        len(test_descriptor_strs), len(java_modules), elapsed_time_sec))
+
+    return [yb_dist_tests.TestDescriptor(s) for s in test_descriptor_strs]
+
+
+def new_test_results_summary():
+    """
+    @return an empty summary of test results: a tuple of the set of exit codes, a dictionary mapping
+            languages to numbers of failed tests, and a list of failed test descriptor strings.
+    """
+    return (set(), {}, [])
+
+
+def add_result_to_summary(summary, result):
+    exit_codes, failures_by_language, failed_test_desc_strs = summary
+    exit_codes.add(result.exit_code)
+    if result.exit_code != 0:
+        language = result.test_descriptor.language
+        failures_by_language[language] = failures_by_language.get(language, 0) + 1
+        failed_test_desc_strs.append(result.test_descriptor.descriptor_str)
+    return summary
+
+
+def merge_test_results_summaries(summary, other_summary):
+    exit_codes, failures_by_language, failed_test_desc_strs = summary
+    other_exit_codes, other_failures_by_language, other_failed_test_desc_strs = other_summary
+    exit_codes.update(other_exit_codes)
+    for language, num_failures in other_failures_by_language.iteritems():
+        failures_by_language[language] = failures_by_language.get(language, 0) + num_failures
+    failed_test_desc_strs.extend(other_failed_test_desc_strs)
+    return summary
+
+
+class TestResultsSummaryAccumulatorParam(object):
+    """
+    Implements the interface of PySpark's AccumulatorParam for summaries of test results. We don't
+    inherit from AccumulatorParam so that this script does not need PySpark until Spark is used.
+    """
+    def zero(self, value):
+        return new_test_results_summary()
+
+    def addInPlace(self, summary, other_summary):
+        return merge_test_results_summaries(summary, other_summary)
+
+
+def split_into_partitions(items, num_partitions):
+    """
+    Splits the given list into num_partitions lists, the i-th of which contains the items at
+    positions i, i + num_partitions, i + 2 * num_partitions, etc. of the original list. If the
+    original list is sorted longest-test-first, this spreads long tests evenly across partitions,
+    and each partition still starts with its longest tests.
+    """
+    return [items[i::num_partitions] for i in xrange(num_partitions)]
+
+
+def consume_iterator(iterator):
+    for _ in iterator:
+        pass
+
+
 def is_writable(dir_path):
     return os.access(dir_path, os.W_OK)
 
@@ -364,30 +709,12 @@ def collect_tests(args):
                      "following: YB_LIST_TESTS_ONLY ctest -j<parallelism>.").format(build_root))
 
     java_test_descriptors = []
-    yb_src_root = yb_dist_tests.global_conf.yb_src_root
     if args.run_java_tests:
-        for java_src_root in [os.path.join(yb_src_root, 'java'),
-                              os.path.join(yb_src_root, 'ent', 'java')]:
-            for dir_path, dir_names, file_names in os.walk(java_src_root):
-                rel_dir_path = os.path.relpath(dir_path, java_src_root)
-                for file_name in file_names:
-                    if (file_name.startswith('Test') and
-                        (file_name.endswith('.java') or file_name.endswith('.scala')) or
-                        file_name.endswith('Test.java') or file_name.endswith('Test.scala')) and \
-                       '/src/test/' in rel_dir_path:
-                        test_descriptor_str = os.path.join(rel_dir_path, file_name)
-                        if yb_dist_tests.JAVA_TEST_DESCRIPTOR_RE.match(test_descriptor_str):
-                            java_test_descriptors.append(
-                                    yb_dist_tests.TestDescriptor(test_descriptor_str))
-                        else:
-                            logging.warning("Skipping file (does not match expected pattern): " +
-                                            test_descriptor)
-
-    # TODO: sort tests in the order of reverse historical execution time. If Spark starts running
-    # tasks from the beginning, this will ensure the longest tests start the earliest.
-    #
-    # Right now we just put Java tests first because those tests are entire test classes and will
-    # take longer to run on average.
+        java_test_descriptors = collect_java_tests()
+
+    # We put Java tests first because those tests are entire test classes and will take longer to
+    # run on average. If we have stats from previous runs, main() will further reorder tests in the
+    # order of reverse historical execution time.
     return sorted(java_test_descriptors) + sorted(cpp_test_descriptors)
 
 
@@ -449,6 +776,11 @@ def main():
     parser.add_argument('--failed_test_list',
                         help='A file path to save the list of failed tests to. The format is '
                              'one test descriptor per line.')
+    parser.add_argument('--tasks-per-core', type=int, dest='tasks_per_core',
+                        default=DEFAULT_TASKS_PER_CORE,
+                        help='The number of Spark tasks to split the tests into per core of the '
+                             'Spark cluster (as given by its default parallelism). Each task runs '
+                             'its tests one after another.')
 
     args = parser.parse_args()
 
@@ -471,6 +803,10 @@ def main():
     build_root = global_conf.build_root
     yb_src_root = global_conf.yb_src_root
 
+    # This has to be done before any Spark jobs are started, because the resulting environment
+    # variables are broadcast to Spark executors along with the global configuration.
+    propagate_env_vars()
+
     if not args.run_cpp_tests and not args.run_java_tests:
         fatal_error("At least one of --java or --cpp has to be specified")
 
@@ -490,6 +826,9 @@ def main():
     if args.num_repetitions < 1:
         fatal_error("--num_repetitions must be at least 1, got: {}".format(args.num_repetitions))
 
+    if args.tasks_per_core < 1:
+        fatal_error("--tasks-per-core must be at least 1, got: {}".format(args.tasks_per_core))
+
     failed_test_list_path = args.failed_test_list
     if failed_test_list_path and not is_parent_dir_writable(failed_test_list_path):
         fatal_error(("Parent directory of failed test list destination path ('{}') is not " +
@@ -513,8 +852,6 @@ def main():
         logging.info("No tests to run")
         return
 
-    propagate_env_vars()
-
     # We're only importing PySpark here so that we can debug the part of this script above this line
     # without depending on PySpark libraries.
     num_tests = len(test_descriptors)
@@ -522,13 +859,17 @@ def main():
     if args.max_tests and num_tests > args.max_tests:
         logging.info("Randomly selecting {} tests out of {} possible".format(
                 args.max_tests, num_tests))
-        random.shuffle(test_descriptors)
-        test_descriptors = test_descriptors[:args.max_tests]
+        test_descriptors = random.sample(test_descriptors, args.max_tests)
         num_tests = len(test_descriptors)
 
+    if stats_dir:
+        # Spark starts running tasks from the beginning, so this ensures the longest tests start
+        # the earliest.
+        test_descriptors = sort_tests_by_prior_elapsed_time(test_descriptors, stats_dir)
+
     if args.verbose:
         for test_descriptor in test_descriptors:
-            logging.info("Will run test: {}".format(test_descriptor))
+            logging.info("Will run test: %s", test_descriptor)
 
     num_repetitions = args.num_repetitions
     total_num_tests = num_tests * num_repetitions
@@ -545,14 +886,44 @@ def main():
     init_spark_context()
     set_global_conf_for_spark_jobs()
 
+    # Having one Spark task per test would make task scheduling overhead significant, so we run a
+    # few tests per task, while still creating enough tasks to keep all cores busy when tests take
+    # different amounts of time. Note that losing an executor re-runs every test in the partitions
+    # of the tasks it was running, including tests that had already finished.
+    num_slices = min(total_num_tests, spark_context.defaultParallelism * args.tasks_per_core)
+    logging.info("Running tests in {} Spark tasks".format(num_slices))
+
     # By this point, test_descriptors have been duplicated the necessary number of times, with
-    # attempt indexes attached to each test descriptor.
+    # attempt indexes attached to each test descriptor. We only send descriptor strings (which
+    # include the attempt index) to Spark, and construct TestDescriptor objects on the workers.
+    #
+    # We build the contents of each partition ourselves, because SparkContext.parallelize groups
+    # items into batches before splitting them into slices, so slice boundaries only fall where we
+    # expect when the number of items is a multiple of the number of slices. Parallelizing exactly
+    # one list per slice gives each task exactly that list.
     test_names_rdd = spark_context.parallelize(
-            [test_descriptor.descriptor_str for test_descriptor in test_descriptors],
-            numSlices=total_num_tests)
+            split_into_partitions(
+                [test_descriptor.descriptor_str for test_descriptor in test_descriptors],
+                num_slices),
+            numSlices=num_slices).flatMap(lambda test_descriptor_strs: test_descriptor_strs)
+
+    global test_results_summary_accumulator
+    test_results_summary_accumulator = spark_context.accumulator(
+            new_test_results_summary(), TestResultsSummaryAccumulatorParam())
 
-    results = test_names_rdd.map(parallel_run_test).collect()
-    exit_codes = set([result.exit_code for result in results])
+    test_results_rdd = test_names_rdd.mapPartitions(parallel_run_tests)
+    if stats_dir and write_stats:
+        # We need all the results on the driver to save per-test stats.
+        results = test_results_rdd.collect()
+    else:
+        # The summary we need is computed using the accumulator, so just run the tests.
+        results = None
+        test_results_rdd.foreachPartition(consume_iterator)
+    exit_codes, failures_by_language, failed_test_desc_strs = \
+        test_results_summary_accumulator.value
+    # The accumulator merges results in the order tasks finish, so sort the failed tests to make
+    # the output deterministic.
+    failed_test_desc_strs = sorted(failed_test_desc_strs)
 
     if exit_codes == set([0]):
         global_exit_code = 0
@@ -561,13 +932,8 @@ def main():
 
     logging.info("Tests are done, set of exit codes: {}, will return exit code {}".format(
         sorted(exit_codes), global_exit_code))
-    failures_by_language = defaultdict(int)
-    failed_test_desc_strs = []
-    for result in results:
-        if result.exit_code != 0:
-            logging.info("Test failed: {}".format(result.test_descriptor))
-            failures_by_language[result.test_descriptor.language] += 1
-            failed_test_desc_strs.append(result.test_descriptor.descriptor_str)
+    for failed_test_desc_str in failed_test_desc_strs:
+        logging.info("Test failed: %s", failed_test_desc_str)
 
     if failed_test_list_path:
         logging.info("Writing the list of failed tests to '{}'".format(failed_test_list_path))
@@ -27,16 +27,31 @@ TEST_DESCRIPTOR_SEPARATOR = ":::"
 
 JAVA_TEST_DESCRIPTOR_RE = re.compile(r'^([a-z0-9-]+)/src/test/(?:java|scala)/(.*)$')
 
+# Java/Scala test source file names look like this.
+JAVA_TEST_FILE_NAME_RE = re.compile(r'^(?:Test.*|.*Test)\.(?:java|scala)$')
+
+# Directories we never look for Java tests in, in addition to hidden directories.
+JAVA_TEST_SEARCH_EXCLUDED_DIR_NAMES = set(['target'])
+
 TEST_DESCRIPTOR_ATTEMPT_PREFIX = TEST_DESCRIPTOR_SEPARATOR + 'attempt_'
 TEST_DESCRIPTOR_ATTEMPT_INDEX_RE = re.compile(
     r'^(.*)' + TEST_DESCRIPTOR_ATTEMPT_PREFIX + r'(\d+)$')
 
 global_conf = None
 
+# The configuration dictionary and the environment variables that init_spark_worker last
+# initialized global_conf and the environment from. PySpark reuses Python worker processes across
+# tasks, and the values of broadcast variables are loaded once per worker process, so we only need
+# to do the initialization once in each process.
+spark_worker_init_source = None
+
 CLOCK_SYNC_WAIT_LOGGING_INTERVAL_SEC = 10
 
 MAX_TIME_TO_WAIT_FOR_CLOCK_SYNC_SEC = 60
 
+# Set to True once wait_for_clock_sync_once has seen the clock synchronized in this process.
+clock_sync_checked = False
+
 
 class TestDescriptor:
     """
@@ -198,6 +213,57 @@ def set_global_conf_from_dict(global_conf_dict):
     return global_conf
 
 
+def init_spark_worker(global_conf_dict, propagated_env_vars):
+    """
+    Sets global_conf from the given dictionary and configures the environment in functions that run
+    on Spark. This does nothing if it has already been done in this process using the very same
+    dictionary objects.
+    """
+    global spark_worker_init_source
+    if (global_conf is None or spark_worker_init_source is None or
+            spark_worker_init_source[0] is not global_conf_dict or
+            spark_worker_init_source[1] is not propagated_env_vars):
+        set_global_conf_from_dict(global_conf_dict)
+        global_conf.set_env(propagated_env_vars)
+        spark_worker_init_source = (global_conf_dict, propagated_env_vars)
+    return global_conf
+
+
+def is_java_test_search_dir_name(dir_name):
+    return dir_name not in JAVA_TEST_SEARCH_EXCLUDED_DIR_NAMES and not dir_name.startswith('.')
+
+
+def find_java_test_descriptor_strs(java_src_root, java_module_name):
+    """
+    Walks the given Maven module directory inside a Java source root and finds Java/Scala tests
+    there.
+
+    @return a tuple of the list of test descriptor strings (test source paths relative to the
+            source root), and the list of paths of files that are named like tests but do not match
+            the expected test descriptor pattern. This is called on Spark workers, where logging is
+            not configured, so the latter are returned to be reported on the driver.
+    """
+    test_descriptor_strs = []
+    skipped_paths = []
+    for dir_path, dir_names, file_names in os.walk(os.path.join(java_src_root, java_module_name)):
+        # Prune subtrees that cannot contain tests, modifying the list in place so that os.walk
+        # does not descend into them.
+        dir_names[:] = [
+            dir_name for dir_name in dir_names if is_java_test_search_dir_name(dir_name)]
+        rel_dir_path = os.path.relpath(dir_path, java_src_root)
+        if '/src/test/' not in rel_dir_path:
+            continue
+        for file_name in file_names:
+            if not JAVA_TEST_FILE_NAME_RE.match(file_name):
+                continue
+            test_descriptor_str = os.path.join(rel_dir_path, file_name)
+            if JAVA_TEST_DESCRIPTOR_RE.match(test_descriptor_str):
+                test_descriptor_strs.append(test_descriptor_str)
+            else:
+                skipped_paths.append(test_descriptor_str)
+    return test_descriptor_strs, skipped_paths
+
+
 def is_clock_synchronized():
     result = command_util.run_program('ntpstat', error_ok=True)
     return ClockSyncCheckResult(
@@ -229,3 +295,15 @@ def wait_for_clock_sync():
     if waited_for_clock_sync:
         cur_time = time.time()
         logging.info("Waited for %.2f for clock synchronization" % (cur_time - start_time))
+
+
+def wait_for_clock_sync_once():
+    """
+    Same as wait_for_clock_sync, but only does anything the first time it succeeds in a particular
+    process. Spark worker processes run many tests one after another, and the clock does not need to
+    be re-checked before each of them.
+    """
+    global clock_sync_checked
+    if not clock_sync_checked:
+        wait_for_clock_sync()
+        clock_sync_checked = True